@@ -1,11 +1,22 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, request
 from flask_cors import CORS
 import json
+import orjson
 import os
+import random
 import re
-from github import Github
+from github import Github, GithubException
 from datetime import datetime
 import base64
+import gzip
+import hashlib
+import threading
+import time
+from bisect import bisect_right
+from collections import defaultdict
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 app = Flask(__name__)
 CORS(app)
@@ -16,140 +27,533 @@ GITHUB_REPO = os.environ.get('GITHUB_REPO', 'AlfaLuaTest/piano-sheets-db')
 GITHUB_BRANCH = 'main'
 SHEETS_FILE_PATH = 'sheets/piano_sheets.json'
 FAVORITES_FILE_PATH = 'users/data.js'
+RAW_SHEETS_URL = f"https://raw.githubusercontent.com/{GITHUB_REPO}/{GITHUB_BRANCH}/{SHEETS_FILE_PATH}"
+
+# Lenient data.js parsing, only used when the file isn't plain JSON
+_FAV_BLOCK_RE = re.compile(r'favorites\s*=\s*({[\s\S]*?});')
+_JS_COMMENT_RE = re.compile(r'//.*?\n')
+_TRAILING_COMMA_RE = re.compile(r',(\s*[}\]])')
+
+# Cache Configuration (seconds before GitHub is asked again)
+CACHE_TTL = int(os.environ.get('CACHE_TTL', 60))
+HTTP_TIMEOUT = 30
+# Cached bodies smaller than this are not worth compressing
+GZIP_MIN_SIZE = 1024
 
 # Initialize GitHub client
 g = Github(GITHUB_TOKEN) if GITHUB_TOKEN else None
 repo = g.get_repo(GITHUB_REPO) if g else None
 
+# Shared HTTP session - keeps the connection to GitHub alive between refreshes
+# and retries GitHub's transient rate-limit / gateway errors with backoff
+http = requests.Session()
+_http_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504])
+)
+http.mount('https://', _http_adapter)
+http.mount('http://', _http_adapter)
+
+# Dedicated RNG for /api/random
+_RNG = random.Random()
+
+def reset_connections():
+    """Drop pooled HTTP connections, e.g. in a worker right after fork"""
+    http.close()
+    if g:
+        g.close()
+
+# Process-local caches for GitHub data, keyed by ETag / file SHA. Each one
+# holds a single snapshot dict that is swapped in one assignment, so readers
+# never see songs from one version and projections from another.
+_CACHE = {'snapshot': None, 'ts': 0.0, 'etag': None}
+_CACHE_LOCK = threading.Lock()
+_FAV_CACHE = {'snapshot': None, 'ts': 0.0}
+_FAV_LOCK = threading.Lock()
+# Serializes favorites writes so in-process updates never race on the SHA
+_FAV_WRITE_LOCK = threading.Lock()
+# PyGithub's shared Requester connection isn't thread-safe: every repo.*
+# call goes through this lock. Innermost - take no other lock while holding it
+_GITHUB_LOCK = threading.Lock()
+
+def get_derived_data():
+    """Get the songs snapshot (songs plus projections), refreshed after the TTL"""
+    snapshot = _CACHE['snapshot']
+    if snapshot is not None and time.monotonic() - _CACHE['ts'] < CACHE_TTL:
+        return snapshot, None
+    
+    # Stale-while-revalidate: one thread refreshes, the others keep serving
+    # the stale copy instead of queueing behind the GitHub round-trip.
+    # Only a cold cache makes requests wait.
+    if not _CACHE_LOCK.acquire(blocking=snapshot is None):
+        return snapshot, None
+    try:
+        # Another thread may have refreshed while we waited for the lock
+        if _CACHE['snapshot'] is not None and time.monotonic() - _CACHE['ts'] < CACHE_TTL:
+            return _CACHE['snapshot'], None
+        
+        songs, etag, error = fetch_songs_data(_CACHE['etag'])
+        if error:
+            if _CACHE['snapshot'] is None:
+                return None, error
+            # Keep serving the last good copy, retry after the next TTL
+            print(f"  → Serving cached songs, refresh failed: {error}")
+        elif songs is not None:
+            try:
+                _CACHE['snapshot'] = build_derived_data(songs)
+            except Exception as e:
+                print(f"ERROR in build_derived_data: {str(e)}")
+                import traceback
+                traceback.print_exc()
+                if _CACHE['snapshot'] is None:
+                    return None, str(e)
+                # Same as a failed fetch: keep the last good copy. Remember the
+                # bad version's ETag so it isn't downloaded again every TTL
+                print("  → Serving cached songs, new sheets file could not be processed")
+            _CACHE['etag'] = etag
+        
+        _CACHE['ts'] = time.monotonic()
+        return _CACHE['snapshot'], None
+    finally:
+        _CACHE_LOCK.release()
+
 def get_songs_data():
-    """Get songs data from GitHub - FIXED for large files"""
+    """Get songs data, served from the TTL cache when fresh"""
+    derived, error = get_derived_data()
+    if error:
+        return None, error
+    return derived['songs'], None
+
+def build_derived_data(songs):
+    """Precompute endpoint projections once per songs refresh
+    
+    Everything is filled in a single pass over the songs.
+    """
+    simplified = []
+    categories = set()
+    by_id = {}
+    by_category = defaultdict(list)
+    search_index = []
+    search_parts = []
+    search_starts = []
+    offset = 0
+    search_trigrams = defaultdict(list)
+    artists = set()
+    difficulties = {}
+    total_sheets = 0
+    
+    for song in songs:
+        get = song.get
+        url = get('url') or ''
+        song_categories = get('categories') or []
+        artist = get('artist', 'Unknown')
+        
+        simplified.append({
+            'title': get('title'),
+            'artist': artist,
+            'url': get('url'),
+            'difficulty': get('difficulty', 'Normal'),
+            'thumbnail': get('thumbnail'),
+            'id': url.split('/')[-1],
+            'categories': get('categories', [])
+        })
+        
+        # Slug (last URL segment) -> song; first entry wins like the old scan
+        by_id.setdefault(url.rsplit('/', 1)[-1], song)
+        
+        # Lowercased category -> songs, each song listed once per category
+        categories.update(song_categories)
+        for cat in {c.lower() for c in song_categories}:
+            by_category[cat].append(song)
+        
+        # Lowercased rows so searches don't call .lower() per song, plus one
+        # blob of every searchable string with the offset where each song starts
+        title_lower = (get('title') or '').lower()
+        artist_lower = (get('artist') or '').lower()
+        search_index.append((title_lower, artist_lower, song))
+        record = f'{title_lower}\x00{artist_lower}\x00'
+        search_starts.append(offset)
+        search_parts.append(record)
+        offset += len(record)
+        # Trigram -> song positions; appended in song order, one entry per song
+        position = len(search_index) - 1
+        for gram in trigrams(title_lower) | trigrams(artist_lower):
+            search_trigrams[gram].append(position)
+        
+        # Song-level part of /api/stats
+        if artist and artist != 'Unknown Artist':
+            artists.add(artist)
+        difficulty = get('difficulty', 'Unknown')
+        difficulties[difficulty] = difficulties.get(difficulty, 0) + 1
+        total_sheets += len(get('sheets') or [])
+    
+    categories_sorted = sorted(categories)
+    
+    # Serialized bodies for the big static endpoints, reused until the next refresh
+    responses = {
+        'songs': build_cached_body({'count': len(simplified), 'songs': simplified}),
+        'songs_full': build_cached_body({'count': len(songs), 'songs': songs}),
+        'categories': build_cached_body({'count': len(categories_sorted), 'categories': categories_sorted})
+    }
+    
+    return {
+        'songs': songs,
+        'simplified': simplified,
+        'categories_sorted': categories_sorted,
+        'stats': {
+            'total_songs': len(songs),
+            'total_artists': len(artists),
+            'total_categories': len(categories),
+            'total_sheets': total_sheets,
+            'difficulties': difficulties
+        },
+        'by_id': by_id,
+        'by_category': dict(by_category),
+        'search_index': search_index,
+        'search_blob': ''.join(search_parts),
+        'search_starts': search_starts,
+        'search_trigrams': dict(search_trigrams),
+        'responses': responses,
+        # (favorites dict, cached body) for /api/stats, rebuilt when favorites change
+        'stats_response': (None, None),
+        # id(song) -> cached body for /api/song/<id>, filled on first request
+        'song_responses': {}
+    }
+
+def trigrams(text):
+    """Set of every 3-character substring of text"""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def find_matching_songs(derived, query):
+    """Find songs whose lowercased title or artist contains query
+    
+    Any string containing the query contains all of its trigrams, so
+    intersecting the trigram postings gives a small candidate set to
+    confirm with a substring check. Queries shorter than three
+    characters fall back to scanning the search blob.
+    """
+    if len(query) < 3:
+        return scan_search_blob(derived, query)
+    
+    postings = derived['search_trigrams']
+    lists = sorted((postings.get(gram, ()) for gram in trigrams(query)), key=len)
+    candidates = set(lists[0])
+    for positions in lists[1:]:
+        if not candidates:
+            break
+        candidates.intersection_update(positions)
+    
+    index = derived['search_index']
+    results = []
+    for i in sorted(candidates):
+        title, artist, song = index[i]
+        if query in title or query in artist:
+            results.append(song)
+    return results
+
+def scan_search_blob(derived, query):
+    """Find matching songs by running str.find over the search blob
+    
+    Each hit is mapped back to its song with a bisect, then the scan
+    jumps to the next song's record.
+    """
+    blob = derived['search_blob']
+    starts = derived['search_starts']
+    index = derived['search_index']
+    
+    results = []
+    pos = blob.find(query)
+    while pos != -1:
+        i = bisect_right(starts, pos) - 1
+        title, artist, song = index[i]
+        # A hit can only straddle fields if the query itself contains the separator
+        if query in title or query in artist:
+            results.append(song)
+        if i + 1 == len(starts):
+            break
+        pos = blob.find(query, starts[i + 1])
+    return results
+
+def build_cached_body(data):
+    """Serialize (and gzip) data once and tag it with a strong ETag"""
+    body = to_json_bytes(data)
+    cached = {'body': body, 'etag': hashlib.sha1(body).hexdigest(), 'gzip': None}
+    if len(body) >= GZIP_MIN_SIZE:
+        cached['gzip'] = gzip.compress(body, compresslevel=6, mtime=0)
+    return cached
+
+def fetch_songs_data(cached_etag=None):
+    """Get songs data straight from the raw file on GitHub
+    
+    Skips the contents API (base64 payload, extra PyGithub objects).
+    Returns (songs, etag, error). songs is None when GitHub answers
+    304 for cached_etag, so the download and parse are skipped.
+    """
     try:
-        if not repo:
-            print("ERROR: GitHub not configured - GITHUB_TOKEN missing")
-            return None, "GitHub not configured - check GITHUB_TOKEN environment variable"
+        print(f"Fetching songs from: {RAW_SHEETS_URL}")
         
-        print(f"Fetching songs from: {GITHUB_REPO}/{SHEETS_FILE_PATH}")
+        headers = {}
+        if GITHUB_TOKEN:
+            headers['Authorization'] = f'token {GITHUB_TOKEN}'
+        if cached_etag:
+            headers['If-None-Match'] = cached_etag
         
-        # FIX: Use raw content URL for large files
-        try:
-            file = repo.get_contents(SHEETS_FILE_PATH, ref=GITHUB_BRANCH)
-            
-            # Check if encoding is 'none' (file too large)
-            if file.encoding == 'none':
-                print("  → File too large, using download_url instead")
-                import requests
-                response = requests.get(file.download_url)
-                content = response.text
-            else:
-                # Normal decoding for smaller files
-                content = file.decoded_content.decode()
-            
-            songs = json.loads(content)
-            print(f"  ✓ Successfully loaded {len(songs)} songs!")
-            return songs, None
-            
-        except AssertionError as ae:
-            # Fallback: direct raw URL
-            print(f"  → AssertionError, using raw URL: {str(ae)}")
-            raw_url = f"https://raw.githubusercontent.com/{GITHUB_REPO}/{GITHUB_BRANCH}/{SHEETS_FILE_PATH}"
-            import requests
-            response = requests.get(raw_url)
-            songs = json.loads(response.text)
-            print(f"  ✓ Loaded {len(songs)} songs via raw URL!")
-            return songs, None
+        response = http.get(RAW_SHEETS_URL, headers=headers, timeout=HTTP_TIMEOUT)
+        if response.status_code == 304:
+            print("  ✓ Songs unchanged, reusing cached copy")
+            return None, cached_etag, None
+        response.raise_for_status()
+        
+        # orjson parses the raw bytes directly, no str decode needed
+        songs = orjson.loads(response.content)
+        print(f"  ✓ Successfully loaded {len(songs)} songs!")
+        return songs, response.headers.get('ETag'), None
             
     except Exception as e:
-        print(f"ERROR in get_songs_data: {str(e)}")
+        print(f"ERROR in fetch_songs_data: {str(e)}")
         import traceback
         traceback.print_exc()
-        return None, str(e)
+        return None, None, str(e)
+
+def get_favorites_snapshot():
+    """Get the favorites snapshot (favorites, sets, sha), refreshed after the TTL"""
+    snapshot = _FAV_CACHE['snapshot']
+    if snapshot is not None and time.monotonic() - _FAV_CACHE['ts'] < CACHE_TTL:
+        return snapshot, None
+    
+    with _FAV_LOCK:
+        snapshot = _FAV_CACHE['snapshot']
+        if snapshot is not None and time.monotonic() - _FAV_CACHE['ts'] < CACHE_TTL:
+            return snapshot, None
+        
+        favorites, sha, error = fetch_all_favorites(snapshot['sha'] if snapshot else None)
+        if error:
+            if snapshot is None or "not configured" in error:
+                return None, error
+            print(f"  → Serving cached favorites, refresh failed: {error}")
+        elif favorites is not None:
+            _FAV_CACHE['snapshot'] = build_favorites_snapshot(favorites, sha)
+        
+        _FAV_CACHE['ts'] = time.monotonic()
+        return _FAV_CACHE['snapshot'], None
+
+def build_favorites_snapshot(favorites, sha):
+    """Bundle favorites with their membership sets, the data.js SHA and
+    prebuilt response bodies, all tied to this one version of the file"""
+    return {
+        'favorites': favorites,
+        'sets': {uid: set(favs) for uid, favs in favorites.items()},
+        'sha': sha,
+        'users_count': build_cached_body({
+            'total_users': len(favorites),
+            'users': list(favorites.keys())
+        }),
+        # Per-user bodies, filled on first request for users that exist
+        'user_responses': {}
+    }
 
 def get_all_favorites():
-    """Get all users' favorites from data.js"""
+    """Get all users' favorites, served from the TTL cache when fresh"""
+    snapshot, error = get_favorites_snapshot()
+    if error:
+        return {}, error
+    return snapshot['favorites'], None
+
+def store_favorites_cache(favorites, sha):
+    """Replace the cached favorites with a freshly written copy"""
+    with _FAV_LOCK:
+        _FAV_CACHE['snapshot'] = build_favorites_snapshot(favorites, sha)
+        _FAV_CACHE['ts'] = time.monotonic()
+
+def refresh_favorites_snapshot():
+    """Revalidate the cached favorites against data.js on GitHub now
+    
+    One get_contents call; the file is only parsed again when its SHA
+    changed. Unlike get_favorites_snapshot, a failed check is an error
+    rather than a fallback to the cached copy.
+    """
+    with _FAV_LOCK:
+        snapshot = _FAV_CACHE['snapshot']
+        favorites, sha, error = fetch_all_favorites(snapshot['sha'] if snapshot else None)
+        if error:
+            return None, error
+        if favorites is not None:
+            snapshot = build_favorites_snapshot(favorites, sha)
+            _FAV_CACHE['snapshot'] = snapshot
+        
+        _FAV_CACHE['ts'] = time.monotonic()
+        return snapshot, None
+
+def fetch_all_favorites(cached_sha=None):
+    """Get all users' favorites from data.js
+    
+    Returns (favorites, sha, error). favorites is None when the file
+    SHA still matches cached_sha.
+    """
     try:
         if not repo:
-            return {}, "GitHub not configured"
+            return {}, None, "GitHub not configured"
         
-        file = repo.get_contents(FAVORITES_FILE_PATH, ref=GITHUB_BRANCH)
+        # ContentFile attributes can lazily hit the API, so read them here too
+        with _GITHUB_LOCK:
+            file = repo.get_contents(FAVORITES_FILE_PATH, ref=GITHUB_BRANCH)
+            sha = file.sha
+            if cached_sha and sha == cached_sha:
+                return None, sha, None
+            # Handle large files
+            if file.encoding == 'none':
+                download_url, content = file.download_url, None
+            else:
+                download_url, content = None, file.decoded_content
         
-        # Handle large files
-        if file.encoding == 'none':
-            import requests
-            content = requests.get(file.download_url).text
-        else:
-            content = file.decoded_content.decode()
+        if download_url:
+            content = http.get(download_url, timeout=HTTP_TIMEOUT).content
         
-        # Parse JavaScript object
-        match = re.search(r'favorites\s*=\s*({[\s\S]*?});', content)
-        if match:
-            json_str = match.group(1)
-            # Remove comments
-            json_str = re.sub(r'//.*?\n', '', json_str)
-            # Replace single quotes with double quotes
-            json_str = json_str.replace("'", '"')
-            # Remove trailing commas before closing braces
-            json_str = re.sub(r',(\s*[}\]])', r'\1', json_str)
-            
-            try:
-                favorites = json.loads(json_str)
-                return favorites, None
-            except json.JSONDecodeError as e:
-                print(f"JSON Parse Error: {e}")
-                print(f"Problematic JSON: {json_str[:200]}")
-                return {}, None
-        return {}, None
+        return parse_favorites_js(content), sha, None
     except Exception as e:
-        return {}, str(e)
+        return {}, None, str(e)
+
+def parse_favorites_js(content):
+    """Parse the favorites object out of data.js bytes
+    
+    _write_user_favorites always emits plain JSON between
+    `favorites = ` and the closing `};`, so that slice goes straight
+    to orjson. Hand-edited files fall back to the lenient cleanup.
+    """
+    start = content.find(b'favorites = {')
+    end = content.rfind(b'}')
+    if start != -1 and end != -1:
+        try:
+            return orjson.loads(content[start + len(b'favorites = '):end + 1])
+        except orjson.JSONDecodeError:
+            pass
+    
+    # Parse JavaScript object
+    match = _FAV_BLOCK_RE.search(content.decode())
+    if match:
+        json_str = match.group(1)
+        # Remove comments
+        json_str = _JS_COMMENT_RE.sub('', json_str)
+        # Replace single quotes with double quotes
+        json_str = json_str.replace("'", '"')
+        # Remove trailing commas before closing braces
+        json_str = _TRAILING_COMMA_RE.sub(r'\1', json_str)
+        
+        try:
+            return json.loads(json_str)
+        except json.JSONDecodeError as e:
+            print(f"JSON Parse Error: {e}")
+            print(f"Problematic JSON: {json_str[:200]}")
+    return {}
 
 def get_user_favorites(user_id):
-    """Get specific user's favorites"""
+    """Get specific user's favorites (a copy, safe to modify)"""
     all_favs, error = get_all_favorites()
     if error:
         return [], error
-    return all_favs.get(user_id, []), None
+    return list(all_favs.get(user_id, [])), None
 
-def update_user_favorites(user_id, favorites_list):
-    """Update specific user's favorites in data.js"""
+def update_user_favorites(user_id, song_id, add=True):
+    """Add or remove song_id in a user's favorites and commit data.js
+    
+    The change is applied to data.js as it is on GitHub right now (the
+    SHA is revalidated under the write lock, and again after a 409), so
+    favorites committed by other workers in the meantime are kept.
+    Returns (favorites, changed, error). changed is False when the song
+    was already in (add) or not in (remove) the user's list.
+    """
     try:
         if not repo:
-            return False, "GitHub not configured"
-        
-        file = repo.get_contents(FAVORITES_FILE_PATH, ref=GITHUB_BRANCH)
+            return [], False, "GitHub not configured"
         
-        all_favs, error = get_all_favorites()
-        if error and "not configured" in error:
-            return False, error
-        
-        all_favs[user_id] = favorites_list
-        
-        # Convert to JavaScript format
-        js_content = "export const favorites = {\n"
-        for uid, favs in all_favs.items():
-            songs_str = ', '.join([f'"{song}"' for song in favs])
-            js_content += f'  "{uid}": [{songs_str}],\n'
-        js_content = js_content.rstrip(',\n') + '\n};\n'
-        
-        new_content = f"""// Auto-generated favorites list
+        with _FAV_WRITE_LOCK:
+            for attempt in range(2):
+                snapshot, error = refresh_favorites_snapshot()
+                if error:
+                    return [], False, error
+                
+                favorites = list(snapshot['favorites'].get(user_id, []))
+                if (song_id in snapshot['sets'].get(user_id, ())) == add:
+                    return favorites, False, None
+                
+                if add:
+                    favorites.append(song_id)
+                else:
+                    # Single filtering pass instead of a membership scan plus list.remove
+                    favorites = [s for s in favorites if s != song_id]
+                
+                try:
+                    _write_user_favorites(snapshot, user_id, favorites)
+                    return favorites, True, None
+                except GithubException as e:
+                    if e.status != 409 or attempt:
+                        raise
+                    # File changed between our check and the write - apply again on top
+                    print(f"  → Favorites SHA conflict, retrying: {e}")
+    except Exception as e:
+        return [], False, str(e)
+
+def _write_user_favorites(snapshot, user_id, favorites_list):
+    """Render data.js from snapshot with user_id's list replaced and commit it"""
+    # Copy so the cached dict is never modified before the write lands
+    all_favs = dict(snapshot['favorites'])
+    all_favs[user_id] = list(favorites_list)
+    
+    # Convert to JavaScript format (valid JSON, so reads can skip the regex cleanup)
+    js_content = "export const favorites = {\n"
+    for uid, favs in all_favs.items():
+        songs_str = ', '.join([orjson.dumps(song).decode() for song in favs])
+        js_content += f'  {orjson.dumps(uid).decode()}: [{songs_str}],\n'
+    js_content = js_content.rstrip(',\n') + '\n};\n'
+    
+    new_content = f"""// Auto-generated favorites list
 // Multi-user support - each user has their own favorites
 // Updated: {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC
 
 {js_content}"""
-        
-        repo.update_file(
+    
+    with _GITHUB_LOCK:
+        result = repo.update_file(
             FAVORITES_FILE_PATH,
             f"Update favorites for user {user_id}",
             new_content,
-            file.sha,
+            snapshot['sha'],
             branch=GITHUB_BRANCH
         )
-        
-        return True, None
-    except Exception as e:
-        return False, str(e)
+        new_sha = result['content'].sha
+    # Write-through: the next read is served from memory
+    store_favorites_cache(all_favs, new_sha)
+
+def to_json_bytes(data):
+    """Serialize with orjson - much faster than the stdlib for large song lists"""
+    return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+def json_response(data, status=200):
+    """Return data as a JSON response serialized with orjson"""
+    return raw_json_response(to_json_bytes(data), status)
+
+def raw_json_response(body, status=200):
+    """Return already-serialized JSON bytes as a response"""
+    return Response(body, status=status, mimetype='application/json')
+
+def cached_json_response(cached, max_age=CACHE_TTL):
+    """Serve a prebuilt body, answering 304 when the client's ETag matches"""
+    if cached['gzip'] is not None and request.accept_encodings['gzip']:
+        response = raw_json_response(cached['gzip'])
+        response.content_encoding = 'gzip'
+        response.set_etag(f"{cached['etag']}-gzip")
+    else:
+        response = raw_json_response(cached['body'])
+        response.set_etag(cached['etag'])
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
 
 @app.route('/')
 def index():
-    return jsonify({
+    return json_response({
         'status': 'online',
         'name': 'Matcha Piano Sheets API',
         'version': '2.2.0',
@@ -175,53 +579,49 @@ def index():
 @app.route('/api/songs', methods=['GET'])
 def get_songs():
     """Return simplified list of all songs"""
-    songs, error = get_songs_data()
+    derived, error = get_derived_data()
     
     if error:
-        return jsonify({'error': error}), 500
-    
-    simplified = [{
-        'title': s.get('title'),
-        'artist': s.get('artist', 'Unknown'),
-        'url': s.get('url'),
-        'difficulty': s.get('difficulty', 'Normal'),
-        'thumbnail': s.get('thumbnail'),
-        'id': s.get('url', '').split('/')[-1],
-        'categories': s.get('categories', [])
-    } for s in songs]
-    
-    return jsonify({
-        'count': len(simplified),
-        'songs': simplified
-    })
+        return json_response({'error': error}, 500)
+    
+    return cached_json_response(derived['responses']['songs'])
 
 @app.route('/api/songs/full', methods=['GET'])
 def get_songs_full():
     """Return complete data for all songs including sheet music"""
-    songs, error = get_songs_data()
+    derived, error = get_derived_data()
     
     if error:
-        return jsonify({'error': error}), 500
+        return json_response({'error': error}, 500)
     
-    return jsonify({
-        'count': len(songs),
-        'songs': songs
-    })
+    return cached_json_response(derived['responses']['songs_full'])
 
 @app.route('/api/song/<path:song_id>', methods=['GET'])
 def get_song(song_id):
     """Get specific song by ID"""
-    songs, error = get_songs_data()
+    derived, error = get_derived_data()
     
     if error:
-        return jsonify({'error': error}), 500
-    
-    for song in songs:
-        url = song.get('url', '')
-        if song_id in url or url.endswith(f'/{song_id}'):
-            return jsonify(song)
-    
-    return jsonify({'error': 'Song not found'}), 404
+        return json_response({'error': error}, 500)
+    
+    # An exact slug wins even when an earlier song's URL merely contains it
+    # (/api/song/home is "home", not "grandmas-home" as with the old scan)
+    song = derived['by_id'].get(song_id)
+    if not song:
+        # Fallback: partial IDs and full URLs still match by substring
+        # (a URL ending in /<id> always contains <id>, so one check covers both)
+        song = next((s for s in derived['songs'] if song_id in (s.get('url') or '')), None)
+    
+    if not song:
+        return json_response({'error': 'Song not found'}, 404)
+    
+    # Songs live as long as their snapshot, so id() is a stable key
+    cached = derived['song_responses'].get(id(song))
+    if cached is None:
+        cached = build_cached_body(song)
+        derived['song_responses'][id(song)] = cached
+    
+    return cached_json_response(cached)
 
 @app.route('/api/search', methods=['GET'])
 def search_songs():
@@ -229,22 +629,16 @@ def search_songs():
     query = request.args.get('q', '').lower().strip()
     
     if not query:
-        return jsonify({'error': 'Query parameter "q" is required'}), 400
+        return json_response({'error': 'Query parameter "q" is required'}, 400)
     
-    songs, error = get_songs_data()
+    derived, error = get_derived_data()
     
     if error:
-        return jsonify({'error': error}), 500
+        return json_response({'error': error}, 500)
     
-    results = []
-    for song in songs:
-        title = song.get('title', '').lower()
-        artist = song.get('artist', '').lower()
-        
-        if query in title or query in artist:
-            results.append(song)
+    results = find_matching_songs(derived, query)
     
-    return jsonify({
+    return json_response({
         'query': query,
         'count': len(results),
         'results': results
@@ -253,36 +647,24 @@ def search_songs():
 @app.route('/api/categories', methods=['GET'])
 def get_categories():
     """Get all available categories"""
-    songs, error = get_songs_data()
+    derived, error = get_derived_data()
     
     if error:
-        return jsonify({'error': error}), 500
-    
-    categories = set()
-    for song in songs:
-        for cat in song.get('categories', []):
-            categories.add(cat)
+        return json_response({'error': error}, 500)
     
-    return jsonify({
-        'count': len(categories),
-        'categories': sorted(list(categories))
-    })
+    return cached_json_response(derived['responses']['categories'])
 
 @app.route('/api/category/<path:category_name>', methods=['GET'])
 def get_songs_by_category(category_name):
     """Get songs filtered by category"""
-    songs, error = get_songs_data()
+    derived, error = get_derived_data()
     
     if error:
-        return jsonify({'error': error}), 500
+        return json_response({'error': error}, 500)
     
-    filtered = []
-    for song in songs:
-        categories = [c.lower() for c in song.get('categories', [])]
-        if category_name.lower() in categories:
-            filtered.append(song)
+    filtered = derived['by_category'].get(category_name.lower(), [])
     
-    return jsonify({
+    return json_response({
         'category': category_name,
         'count': len(filtered),
         'songs': filtered
@@ -291,72 +673,64 @@ def get_songs_by_category(category_name):
 @app.route('/api/stats', methods=['GET'])
 def get_stats():
     """Get database statistics"""
-    songs, error = get_songs_data()
+    derived, error = get_derived_data()
     
     if error:
-        return jsonify({'error': error}), 500
+        return json_response({'error': error}, 500)
     
     all_favs, _ = get_all_favorites()
     
-    total_songs = len(songs)
-    artists = set()
-    difficulties = {}
-    categories = set()
-    total_sheets = 0
+    # Favorites dicts are replaced, never mutated, so identity tracks changes
+    cached_favs, cached = derived['stats_response']
+    if cached_favs is not all_favs:
+        cached = build_cached_body({
+            **derived['stats'],
+            'total_users': len(all_favs),
+            'total_favorites': sum(len(favs) for favs in all_favs.values()),
+            'database_file': SHEETS_FILE_PATH,
+            'repository': GITHUB_REPO
+        })
+        derived['stats_response'] = (all_favs, cached)
     
-    for song in songs:
-        artist = song.get('artist', 'Unknown')
-        if artist and artist != 'Unknown Artist':
-            artists.add(artist)
-        
-        difficulty = song.get('difficulty', 'Unknown')
-        difficulties[difficulty] = difficulties.get(difficulty, 0) + 1
-        
-        for cat in song.get('categories', []):
-            categories.add(cat)
-        
-        total_sheets += len(song.get('sheets', []))
-    
-    return jsonify({
-        'total_songs': total_songs,
-        'total_artists': len(artists),
-        'total_categories': len(categories),
-        'total_sheets': total_sheets,
-        'total_users': len(all_favs),
-        'total_favorites': sum(len(favs) for favs in all_favs.values()),
-        'difficulties': difficulties,
-        'database_file': SHEETS_FILE_PATH,
-        'repository': GITHUB_REPO
-    })
+    return cached_json_response(cached)
 
 @app.route('/api/random', methods=['GET'])
 def get_random_song():
     """Get a random song"""
-    import random
-    
     songs, error = get_songs_data()
     
     if error:
-        return jsonify({'error': error}), 500
+        return json_response({'error': error}, 500)
     
     if not songs:
-        return jsonify({'error': 'No songs available'}), 404
+        return json_response({'error': 'No songs available'}, 404)
     
-    return jsonify(random.choice(songs))
+    return json_response(songs[_RNG.randrange(len(songs))])
 
 @app.route('/api/favorites/<user_id>', methods=['GET'])
 def get_favorites_route(user_id):
     """Get specific user's favorites"""
-    favorites, error = get_user_favorites(user_id)
+    snapshot, error = get_favorites_snapshot()
     
-    if error and "not configured" not in error:
-        favorites = []
+    if error or user_id not in snapshot['favorites']:
+        return json_response({
+            'user_id': user_id,
+            'count': 0,
+            'favorites': []
+        })
     
-    return jsonify({
-        'user_id': user_id,
-        'count': len(favorites),
-        'favorites': favorites
-    })
+    cached = snapshot['user_responses'].get(user_id)
+    if cached is None:
+        favorites = snapshot['favorites'][user_id]
+        cached = build_cached_body({
+            'user_id': user_id,
+            'count': len(favorites),
+            'favorites': favorites
+        })
+        snapshot['user_responses'][user_id] = cached
+    
+    # Favorites change on every add/remove - let clients revalidate each time
+    return cached_json_response(cached, max_age=0)
 
 # ✅ YENİ: GET ve POST desteği
 @app.route('/api/favorites/<user_id>/add', methods=['GET', 'POST'])
@@ -371,26 +745,23 @@ def add_favorite(user_id):
         song_id = data.get('song_id') if data else None
     
     if not song_id:
-        return jsonify({'error': 'song_id is required'}), 400
+        return json_response({'error': 'song_id is required'}, 400)
     
-    favorites, error = get_user_favorites(user_id)
+    # data.js holds slug strings; JSON bodies may carry numbers etc.
+    song_id = str(song_id)
+    
+    favorites, changed, error = update_user_favorites(user_id, song_id, add=True)
     if error:
-        return jsonify({'error': error}), 500
+        return json_response({'error': error}, 500)
     
-    if song_id in favorites:
-        return jsonify({
+    if not changed:
+        return json_response({
             'message': 'Already in favorites',
             'user_id': user_id,
             'favorites': favorites
         })
     
-    favorites.append(song_id)
-    
-    success, error = update_user_favorites(user_id, favorites)
-    if not success:
-        return jsonify({'error': error}), 500
-    
-    return jsonify({
+    return json_response({
         'message': 'Added to favorites',
         'user_id': user_id,
         'count': len(favorites),
@@ -410,27 +781,24 @@ def remove_favorite(user_id):
         song_id = data.get('song_id') if data else None
     
     if not song_id:
-        return jsonify({'error': 'song_id is required'}), 400
+        return json_response({'error': 'song_id is required'}, 400)
+    
+    # data.js holds slug strings; JSON bodies may carry numbers etc.
+    song_id = str(song_id)
     
-    favorites, error = get_user_favorites(user_id)
+    favorites, changed, error = update_user_favorites(user_id, song_id, add=False)
     if error:
-        return jsonify({'error': error}), 500
+        return json_response({'error': error}, 500)
     
-    if song_id in favorites:
-        favorites.remove(song_id)
-        
-        success, error = update_user_favorites(user_id, favorites)
-        if not success:
-            return jsonify({'error': error}), 500
-        
-        return jsonify({
+    if changed:
+        return json_response({
             'message': 'Removed from favorites',
             'user_id': user_id,
             'count': len(favorites),
             'favorites': favorites
         })
     else:
-        return jsonify({
+        return json_response({
             'message': 'Not in favorites',
             'user_id': user_id,
             'favorites': favorites
@@ -439,23 +807,20 @@ def remove_favorite(user_id):
 @app.route('/api/users/count', methods=['GET'])
 def get_user_count():
     """Get total number of users"""
-    all_favs, error = get_all_favorites()
+    snapshot, error = get_favorites_snapshot()
     
     if error:
-        return jsonify({'error': error}), 500
+        return json_response({'error': error}, 500)
     
-    return jsonify({
-        'total_users': len(all_favs),
-        'users': list(all_favs.keys())
-    })
+    return cached_json_response(snapshot['users_count'], max_age=0)
 
 @app.errorhandler(404)
 def not_found(error):
-    return jsonify({'error': 'Endpoint not found'}), 404
+    return json_response({'error': 'Endpoint not found'}, 404)
 
 @app.errorhandler(500)
 def internal_error(error):
-    return jsonify({'error': 'Internal server error'}), 500
+    return json_response({'error': 'Internal server error'}, 500)
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
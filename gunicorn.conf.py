@@ -0,0 +1,24 @@
+# Gunicorn configuration for the Matcha Piano Sheets API
+# Picked up automatically by: gunicorn wsgi:app
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# Threaded workers - a request waiting on GitHub doesn't block the others
+worker_class = 'gthread'
+# One process by default: each worker caches favorites for CACHE_TTL, so a
+# second worker could serve a list from before another worker's add/remove.
+# Writes always revalidate data.js; only reads would be stale with more.
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Load the app (and warm its caches, see wsgi.py) once in the master
+preload_app = True
+
+# Cold cache loads download the full sheets file from GitHub
+timeout = 120
+
+def post_fork(server, worker):
+    # Sockets opened by the master while preloading must not be shared
+    import app
+    app.reset_connections()
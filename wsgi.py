@@ -0,0 +1,10 @@
+"""WSGI entry point - warms the caches before gunicorn forks workers
+
+Run with: gunicorn wsgi:app  (settings come from gunicorn.conf.py)
+"""
+from app import app, get_all_favorites, get_songs_data
+
+# With preload_app the master loads GitHub data once; forked workers
+# inherit the parsed songs through copy-on-write pages
+get_songs_data()
+get_all_favorites()